@@ -1,7 +1,64 @@
 #!/usr/bin/env python3
 
-import argparse, socket, json, select
-from copy import deepcopy
+import argparse, socket, json, selectors, struct
+from collections import defaultdict, deque
+from functools import lru_cache
+
+@lru_cache(maxsize=4096)
+def our_addr(dst):
+    """
+    Returns the IP address of this router based on the given destination address.
+    """
+    quads = list(int(qdn) for qdn in dst.split('.'))
+    quads[3] = 1
+    return "%d.%d.%d.%d" % (quads[0], quads[1], quads[2], quads[3])
+
+@lru_cache(maxsize=4096)
+def ip_to_int(ip):
+    """
+    Converts an IP address to its corresponding 32-bit integer representation.
+    """
+    return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+@lru_cache(maxsize=4096)
+def get_netmask_length(netmask):
+    """ Returns the length of the given net mask. """
+    return ip_to_int(netmask).bit_count()
+
+ORIGIN_RANK = {"IGP": 0, "EGP": 1, "UNK": 2}
+
+def route_pref_key(route):
+    """
+    Sort key implementing the route selection order: longest prefix, highest
+    localpref, selfOrigin, shortest ASPath, best origin, lowest peer address.
+    Lower keys are preferred.
+    """
+    return (-route["_nm_len"], -route["localpref"], not route["selfOrigin"],
+            len(route["ASPath"]), ORIGIN_RANK[route["origin"]], route["peer"])
+
+class PatriciaNode:
+    """
+    A single node of the binary prefix trie used to accelerate route lookups.
+
+    Attributes
+    ----------
+    bit_index : int
+        Depth of this node in the trie (how many prefix bits lead to it).
+    left : PatriciaNode
+        Child for a 0 bit at this position, or None.
+    right : PatriciaNode
+        Child for a 1 bit at this position, or None.
+    routes : list
+        Routes whose network prefix ends exactly at this node.
+    """
+
+    __slots__ = ("bit_index", "left", "right", "routes")
+
+    def __init__(self, bit_index):
+        self.bit_index = bit_index
+        self.left = None
+        self.right = None
+        self.routes = []
 
 class Router:
     """
@@ -17,54 +74,55 @@ class Router:
         Collection of sockets for each neighbor in the connections list.
     ports : dict
         Dictionary of ports for each neighbor.
-    updates : list
-        BGP updates recieved by this router.
+    updates : deque
+        Recent BGP updates recieved by this router (bounded).
     routes : list
         Route forwarding table of this router.
     """
 
-    relations = {}
-    sockets = {}
-    ports = {}
-    updates = []
-    routes = []
-
-    def __init__(self, asn, connections):
+    def __init__(self, asn, connections, verbose=False):
         print("Router at AS %s starting up" % asn)
         self.asn = asn
+        self.verbose = verbose
+        self.relations = {}
+        self.sockets = {}
+        self.ports = {}
+        # Bounded history of received update/withdraw messages; nothing on the
+        # hot path reads it, so cap it instead of growing forever.
+        self.updates = deque(maxlen=1024)
+        self.routes = []
+        self.route_trie = PatriciaNode(0)
+        # epoll/kqueue-backed selector: sockets register once and each ready
+        # event carries its neighbor, replacing the per-loop fd-set build.
+        self.selector = selectors.DefaultSelector()
+        self.send_map = {}
         for relationship in connections:
             port, neighbor, relation = relationship.split("-")
 
             self.sockets[neighbor] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             self.sockets[neighbor].bind(('localhost', 0))
+            self.selector.register(self.sockets[neighbor], selectors.EVENT_READ, neighbor)
             self.ports[neighbor] = int(port)
+            # Bind the sendto method and address tuple up front so the hot
+            # send path does a single dict lookup per call.
+            self.send_map[neighbor] = (self.sockets[neighbor].sendto, ('localhost', int(port)))
             self.relations[neighbor] = relation
-            self.send(neighbor, json.dumps({ "type": "handshake", "src": self.our_addr(neighbor), "dst": neighbor, "msg": {}  }))
-
-    def our_addr(self, dst):
-        """
-        Returns the IP address of this router based on the given destination address.
-        """
-        quads = list(int(qdn) for qdn in dst.split('.'))
-        quads[3] = 1
-        return "%d.%d.%d.%d" % (quads[0], quads[1], quads[2], quads[3])
+            self.send(neighbor, json.dumps({ "type": "handshake", "src": our_addr(neighbor), "dst": neighbor, "msg": {}  }))
+        # Pre-encoded per-neighbor src/dst tail spliced onto broadcast bodies,
+        # so broadcasts never re-encode the addresses.
+        self.bcast_tail = {neighbor: (', "src": "%s", "dst": "%s"}' % (our_addr(neighbor), neighbor)).encode('utf-8')
+                           for neighbor in self.relations}
 
     def send(self, network, message):
         """
-        Sends the given message to the given network address.
+        Sends the given message (str or already-encoded bytes) to the given
+        network address.
         """
-        self.sockets[network].sendto(message.encode('utf-8'), ('localhost', self.ports[network]))
+        sendto, addr = self.send_map[network]
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        sendto(message, addr)
     
-    def ip_to_binary_string(self,ip):
-        """
-        Converts an IP address to its corresponding binary representation.
-        """
-        bin_ip = ""
-        segments=ip.split(".")
-        for segment in segments:
-            bin_ip += '{0:08b}'.format(int(segment))
-        return bin_ip
-
     def netmask_with_length(self, netmask_length):
         """
         Return netmask for a given netmask length.
@@ -81,27 +139,70 @@ class Router:
             ip += "." + str(segment)
         return ip[1:]
 
-    def get_netmask_length(self, netmask):
-        """ Returns the length of the given net mask. """
-        return self.ip_to_binary_string(netmask).count('1')
+    def finalize_route(self, route):
+        """
+        Caches the integer forms of the route's network and netmask on the
+        route dict so the hot paths never re-parse the dotted-quad strings.
+        """
+        route["_net_int"] = ip_to_int(route["network"])
+        route["_nm_int"] = ip_to_int(route["netmask"])
+        route["_nm_len"] = route["_nm_int"].bit_count()
+        # Signature of the five attributes that must match for aggregation;
+        # one int compare rejects almost all non-mergeable pairs.
+        route["_sig"] = hash((route["_nm_int"], route["localpref"], route["selfOrigin"],
+                              route["origin"], route["ASPath"]))
+        return route
+
+    def trie_insert(self, route):
+        """
+        Inserts the given route into the prefix trie, keyed by its network prefix bits.
+        """
+        prefix_int = route["_net_int"]
+        prefix_len = route["_nm_len"]
+        node = self.route_trie
+        for bit_index in range(0, prefix_len):
+            if (prefix_int >> (31 - bit_index)) & 1:
+                if node.right is None:
+                    node.right = PatriciaNode(bit_index + 1)
+                node = node.right
+            else:
+                if node.left is None:
+                    node.left = PatriciaNode(bit_index + 1)
+                node = node.left
+        node.routes.append(route)
+
+    def rebuild_trie(self):
+        """
+        Rebuilds the prefix trie from scratch so it mirrors the current routes table.
+        """
+        self.route_trie = PatriciaNode(0)
+        for route in self.routes:
+            self.trie_insert(route)
 
     def aggregate_routes(self, route1, route2):
         """ 
         Tries to aggregate the given 2 routes based on netmask, localpref, origin, and AS path.
         """
-        if(route1["netmask"]!= route2["netmask"] or route1["localpref"]!= route2["localpref"] 
-            or route1["selfOrigin"]!= route2["selfOrigin"] or route1["ASPath"]!= route2["ASPath"]
-            or route1["origin"]!= route2["origin"]):
+        # Cheap signature check first; on a sig hit, confirm with the real
+        # attributes ordered cheapest compare to most expensive.
+        if route1["_sig"] != route2["_sig"]:
+            return None
+        if(route1["netmask"]!= route2["netmask"] or route1["origin"]!= route2["origin"]
+            or route1["localpref"]!= route2["localpref"] or route1["selfOrigin"]!= route2["selfOrigin"]
+            or route1["ASPath"]!= route2["ASPath"]):
             return None
 
-        netmask_length = self.get_netmask_length(route1["netmask"])
-        route1_ip_binary = self.ip_to_binary_string(route1["network"])
-        route2_ip_binary = self.ip_to_binary_string(route2["network"])
-        if( route1_ip_binary[0: (netmask_length -1)] !=  route2_ip_binary[0: (netmask_length -1)]
-            or route1_ip_binary[netmask_length -1] ==  route2_ip_binary[netmask_length -1]):
-            return None    
+        # The two networks are adjacent iff they differ in exactly one bit and
+        # it is the last prefix bit, i.e. the XOR's only set bit is at
+        # position netmask_length - 1 from the top.
+        netmask_length = route1["_nm_len"]
+        xor = route1["_net_int"] ^ route2["_net_int"]
+        if xor.bit_length() != 33 - netmask_length:
+            return None
 
-        aggregated_route = deepcopy(route1)
+        # Shallow copy is enough: route values are scalars and the shared
+        # ASPath list is never mutated.
+        aggregated_route = route1.copy()
         if route1["network"] > route2["network"]:
             aggregated_route["network"] = route2["network"]
             aggregated_route["child0"] = route2
@@ -110,67 +211,120 @@ class Router:
             aggregated_route["child0"] = route1
             aggregated_route["child1"] = route2
         aggregated_route["netmask"] = self.netmask_with_length(netmask_length - 1)
-        return aggregated_route
+        return self.finalize_route(aggregated_route)
 
     def coalesce(self):
         """
         Performs route aggregation on the entire routes table.
         """
-        aggregated_routes = []
-        for i in range(0, len(self.routes)):
-            for j in range(i + 1, len(self.routes)):
-                aggregated_route = self.aggregate_routes(self.routes[i], self.routes[j])
-                if aggregated_route is not None:
-                    aggregated_routes.append({"route1": self.routes[i], "route2": self.routes[j], "aggregated_route": aggregated_route})
-        for route in aggregated_routes:
-            self.routes.remove(route["route1"])
-            self.routes.remove(route["route2"])
-            self.routes.append(route["aggregated_route"])
-        if len(aggregated_routes) > 0:
-            return self.coalesce()
+        merged_any = False
+        changed = True
+        while changed:
+            changed = False
+
+            # Two routes can only merge if their attributes match and they share
+            # everything but the last prefix bit, so bucket by (attributes,
+            # parent prefix) and only test pairs inside a bucket.
+            buckets = defaultdict(list)
+            for route in self.routes:
+                netmask_length = route["_nm_len"]
+                if netmask_length == 0:
+                    continue
+                key = (route["netmask"], route["localpref"], route["selfOrigin"],
+                       route["ASPath"], route["origin"],
+                       route["_net_int"] >> (33 - netmask_length))
+                buckets[key].append(route)
+
+            removed_ids = set()
+            new_routes = []
+            for bucket in buckets.values():
+                if len(bucket) < 2:
+                    continue
+                # Split the bucket on the last prefix bit; each (0, 1) pair of
+                # siblings aggregates into the parent prefix.
+                netmask_length = bucket[0]["_nm_len"]
+                zeros = [r for r in bucket if not (r["_net_int"] >> (32 - netmask_length)) & 1]
+                ones = [r for r in bucket if (r["_net_int"] >> (32 - netmask_length)) & 1]
+                for route1, route2 in zip(zeros, ones):
+                    aggregated_route = self.aggregate_routes(route1, route2)
+                    if aggregated_route is not None:
+                        removed_ids.add(id(route1))
+                        removed_ids.add(id(route2))
+                        new_routes.append(aggregated_route)
+
+            if new_routes:
+                self.routes = [r for r in self.routes if id(r) not in removed_ids] + new_routes
+                merged_any = True
+                changed = True
+        return merged_any
 
     def handle_update_msg(self, srcif, msg):
         """
         Handles a BGP update message.
         """
         self.updates.append(msg)
-        new_route = deepcopy ( msg["msg"])
+        # Store ASPath as a tuple: hashable for the coalesce buckets, compares
+        # in C, and still serializes as a JSON array in table dumps.
+        new_route = {**msg["msg"], "ASPath": tuple(msg["msg"]["ASPath"])}
         new_route["peer"] = msg["src"]
         new_route["child0"] = None
         new_route["child1"] = None
+        self.finalize_route(new_route)
 
         self.routes.append(new_route)
-        self.coalesce()
+        if self.coalesce():
+            # Aggregation restructured the table, so the trie must be rebuilt.
+            self.rebuild_trie()
+        else:
+            self.trie_insert(new_route)
 
         n_msg = {}
         n_msg["msg"] = {'netmask': msg["msg"]["netmask"], 'ASPath': [self.asn]+msg["msg"]["ASPath"], 'network':msg["msg"]["network"]}
         n_msg["type"] = "update"
+        # Only src/dst vary per neighbor, so serialize and encode the rest of
+        # the message once and splice the pre-encoded address tail in.
+        n_msg_body = json.dumps(n_msg)[:-1].encode('utf-8')
         for neighbor in self.relations.keys():
             if neighbor!=srcif and (self.relations[srcif]=="cust" or self.relations[neighbor]=="cust"):
-                n_msg["src"] = self.our_addr(neighbor)
-                n_msg["dst"] = neighbor
-                self.send(neighbor, json.dumps(n_msg))
+                self.send(neighbor, n_msg_body + self.bcast_tail[neighbor])
         
 
-    def withdraw_route(self, srcif, withdraw_msg, route):
+    def withdraw_route(self, srcif, withdraw_msg, route, route_ids):
         """
         Checks if the given route should be withdrawn based on the given BGP message.
+
+        Searches the aggregation tree iteratively; if the withdrawn route is
+        buried inside an aggregate, the sibling of every node on the path to it
+        is re-added to the table (disaggregation).
         """
-        if (route["network"] == withdraw_msg["network"] and 
-            route["netmask"] == withdraw_msg["netmask"] and 
-            route["peer"] == srcif):
-                # Return true if network, netmask, and peer are the same
-                return True
-        elif not(route["child0"] is None):
-            if self.withdraw_route(srcif, withdraw_msg, route["child0"]):
-                if not (route["child1"] in self.routes):
-                    self.routes.append(route["child1"])
-                return True 
-            elif self.withdraw_route(srcif, withdraw_msg, route["child1"]):
-                if not (route["child0"] in self.routes):
-                    self.routes.append(route["child0"])
-                return True 
-        return False
+        stack = [route]
+        parent_map = {}
+        match = None
+        while stack:
+            node = stack.pop()
+            if (node["network"] == withdraw_msg["network"] and
+                node["netmask"] == withdraw_msg["netmask"] and
+                node["peer"] == srcif):
+                # Matches if network, netmask, and peer are the same
+                match = node
+                break
+            if node["child0"] is not None:
+                parent_map[id(node["child0"])] = node
+                parent_map[id(node["child1"])] = node
+                stack.append(node["child0"])
+                stack.append(node["child1"])
+        if match is None:
+            return False
+
+        node = match
+        while id(node) in parent_map:
+            parent = parent_map[id(node)]
+            sibling = parent["child1"] if parent["child0"] is node else parent["child0"]
+            if id(sibling) not in route_ids:
+                self.routes.append(sibling)
+                route_ids.add(id(sibling))
+            node = parent
+        return True
 
     def handle_withdraw_msg(self, srcif, msg):
         """
@@ -178,62 +332,48 @@ class Router:
         """
         self.updates.append(msg)
         withdraw_routes = []
+        route_ids = {id(route) for route in self.routes}
         for route in self.routes:
             for withdraw_msg in msg["msg"]:
-                if self.withdraw_route(srcif, withdraw_msg, route):
+                if self.withdraw_route(srcif, withdraw_msg, route, route_ids):
                     withdraw_routes.append(route)
 
-        # For each route to be withdrawn, remove it from self.routes if its in it.
-        for withdraw_route in withdraw_routes: 
-            if withdraw_route in self.routes:
-                self.routes.remove(withdraw_route)   
+        # Drop the withdrawn routes in one sweep keyed by id, avoiding the
+        # O(N) deep dict compares of 'in'/list.remove per route.
+        removed_ids = {id(withdraw_route) for withdraw_route in withdraw_routes}
+        if removed_ids:
+            self.routes = [route for route in self.routes if id(route) not in removed_ids]
+        self.rebuild_trie()
 
         # For each neighbor that is a cusomer, send them the withdraw message.
+        # As in handle_update_msg, serialize and encode everything but src/dst once.
+        n_msg_body = json.dumps({k: v for k, v in msg.items() if k not in ("src", "dst")})[:-1].encode('utf-8')
         for neighbor in self.relations.keys():
             if neighbor!=srcif and (self.relations[srcif]=="cust" or self.relations[neighbor]=="cust"):
-                msg["src"] = self.our_addr(neighbor)
-                msg["dst"] = neighbor
-                self.send(neighbor, json.dumps(msg))
+                self.send(neighbor, n_msg_body + self.bcast_tail[neighbor])
         return
 
     def find_routes(self, srcif, dest):
         """
         Finds a route to the given destination address.
         """
-        valid_routes = []
-        valid_netmask_length = -1
+        # Walk the prefix trie along the destination bits; every route stored on the
+        # path has a matching prefix, so only those candidates need tie-breaking.
+        dest_int = ip_to_int(dest)
+        candidates = []
+        node = self.route_trie
+        mask = 1 << 31
+        while node is not None:
+            if node.routes:
+                candidates.extend(node.routes)
+            if mask:
+                node = node.right if dest_int & mask else node.left
+                mask >>= 1
+            else:
+                break
 
-        # Goes through the routing table and decides which addresses will route to the given destination.
-        for route in self.routes:
-            netmask_length = self.get_netmask_length(route["netmask"])
-            if self.ip_to_binary_string(dest)[0:netmask_length] == self.ip_to_binary_string(route["network"])[0:netmask_length]:
-                if valid_netmask_length < netmask_length:
-                    valid_netmask_length = netmask_length
-                    valid_routes = [route]
-                elif valid_netmask_length == netmask_length:
-                    if valid_routes[0]["localpref"] < route["localpref"]:
-                        valid_netmask_length = netmask_length
-                        valid_routes = [route]
-                    elif valid_routes[0]["localpref"] == route["localpref"]:
-                        if (not valid_routes[0]["selfOrigin"]) and route["selfOrigin"]:
-                            valid_netmask_length = netmask_length
-                            valid_routes = [route]
-                        elif valid_routes[0]["selfOrigin"] == route["selfOrigin"]:
-                            if len(valid_routes[0]['ASPath']) > len(route["ASPath"]):
-                                valid_netmask_length = netmask_length
-                                valid_routes = [route]
-                            elif len(valid_routes[0]['ASPath']) == len(route["ASPath"]):
-                                v_origin = valid_routes[0]['origin']
-                                origin = route["origin"]
-                                if (origin == "IGP" and v_origin != "IGP") or (origin =="EGP" and v_origin =="UNK"):
-                                    valid_netmask_length = netmask_length
-                                    valid_routes = [route]
-                                elif origin==v_origin:
-                                    if valid_routes[0]['peer']> route['peer']:
-                                        valid_netmask_length = netmask_length
-                                        valid_routes = [route]
-                                    elif valid_routes[0]['peer']> route['peer']:
-                                        valid_routes.append(route)
+        # The whole selection order collapses into one sort key compared in C.
+        valid_routes = [min(candidates, key=route_pref_key)] if candidates else []
 
 
         # After getting the valid routes, we filter the baed on whether the route goes to a customer or not.
@@ -259,7 +399,7 @@ class Router:
         route = self.find_routes(srcif, msg["dst"])
         if route is None:
             # Send a no route meessage back to the src if we have no way to get to the destination.
-            self.send(srcif, json.dumps({ "type": "no route", "src": self.our_addr(srcif), "dst": msg["src"], "msg": {}  }))
+            self.send(srcif, json.dumps({ "type": "no route", "src": our_addr(srcif), "dst": msg["src"], "msg": {}  }))
         else:
             # Else, send the message if we have a path.
             self.send(route["peer"], json.dumps(msg))
@@ -268,10 +408,9 @@ class Router:
         """
         Handles a dump table message.
         """
-        printable_routes = deepcopy(self.routes)
-        for printable_route in printable_routes:
-            printable_route.pop("child0")
-            printable_route.pop("child1")
+        hidden_keys = ("child0", "child1", "_net_int", "_nm_int", "_nm_len", "_sig")
+        printable_routes = [{k: v for k, v in route.items() if k not in hidden_keys}
+                            for route in self.routes]
 
         self.send(msg["src"], json.dumps({"type": "table", "src": msg["dst"], "dst": msg["src"], "msg": printable_routes}))      
       
@@ -293,17 +432,15 @@ class Router:
         Starts up this router.
         """
         while True:
-            socks = select.select(self.sockets.values(), [], [], 0.1)[0]
-            for conn in socks:
-                k, addr = conn.recvfrom(65535)
-                srcif = None
-                for sock in self.sockets:
-                    if self.sockets[sock] == conn:
-                        srcif = sock
-                        break
+            for key, _ in self.selector.select(timeout=0.1):
+                k, addr = key.fileobj.recvfrom(65535)
+                srcif = key.data
                 msg = json.loads(k)
 
-                print("Received message '%s' from %s" % (msg, srcif))
+                # Formatting and flushing every message stalls the event loop
+                # under load, so only log when asked to.
+                if self.verbose:
+                    print("Received message '%s' from %s" % (msg, srcif))
                 self.handle_msg(srcif, msg)
 
         return
@@ -312,6 +449,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='route packets')
     parser.add_argument('asn', type=int, help="AS number of this router")
     parser.add_argument('connections', metavar='connections', type=str, nargs='+', help="connections")
+    parser.add_argument('-v', '--verbose', action='store_true', help="log every received message")
     args = parser.parse_args()
-    router = Router(args.asn, args.connections)
+    router = Router(args.asn, args.connections, args.verbose)
     router.run()